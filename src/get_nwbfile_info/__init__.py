@@ -2,6 +2,17 @@
 Functions to analyze NWB files and generate Python code for accessing their objects and fields.
 """
 
-from .core import get_nwbfile_usage_script
-
 __version__ = "0.1.1"
+
+_CORE_FUNCTIONS = ("get_nwbfile_usage_script", "iter_nwbfile_usage_script")
+
+def __getattr__(name):
+    # Import the core module on first use, since it imports numpy and h5py,
+    # which are slow to import (pynwb and hdmf are imported when a file is read)
+    if name in _CORE_FUNCTIONS:
+        from . import core
+        return getattr(core, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + list(_CORE_FUNCTIONS))
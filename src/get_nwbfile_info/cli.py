@@ -1,8 +1,8 @@
 """Command-line interface for nwbinfo."""
 
+import os
 import sys
 import click
-from .core import get_nwbfile_usage_script
 
 @click.group()
 def main():
@@ -12,7 +12,10 @@ def main():
 @main.command()
 @click.argument('url')
 @click.option('--output', '-o', type=click.Path(writable=True), help='Output file path. If not provided, prints to stdout.')
-def usage_script(url, output):
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None, help='Directory in which to cache data fetched from remote files (e.g. ~/.cache/get-nwbfile-info). If not provided, nothing is cached on disk.')
+@click.option('--raw', is_flag=True, default=False, help='List the HDF5 groups and datasets directly instead of reading the file with PyNWB. Much faster for large files, but the generated expressions are approximate.')
+@click.option('--use-cache', is_flag=True, default=False, help='Reuse the script generated by a previous run for the same file if the file has not changed since. Scripts are cached in ~/.cache/get-nwbfile-info/scripts.')
+def usage_script(url, output, cache_dir, raw, use_cache):
     """Generate Python code to access NWB file objects and fields.
 
     URL: Can be one of:
@@ -33,15 +36,40 @@ def usage_script(url, output):
 
     # With output file
     get-nwbfile-info usage-script https://api.dandiarchive.org/.../download/ -o output.py
+
+    # Fast structural listing without reading the file with PyNWB
+    get-nwbfile-info usage-script path/to/file.nwb --raw
+
+    # Cache remote data on disk for faster repeated runs
+    get-nwbfile-info usage-script https://api.dandiarchive.org/.../download/ --cache-dir ~/.cache/get-nwbfile-info
+
+    # Reuse the script from a previous run if the file has not changed
+    get-nwbfile-info usage-script DANDI:001349:0.250520.1729:sub-C57-C2-2-AL/sub-C57-C2-2-AL_ses-2_ophys.nwb --use-cache
     """
+    # Imported here so that --help does not pay for importing pynwb
+    from .core import iter_nwbfile_usage_script
+
     try:
-        result = get_nwbfile_usage_script(url)
+        # Write the lines as they are generated rather than building the whole script first
+        lines = iter_nwbfile_usage_script(url, cache_dir=cache_dir, raw=raw, use_cache=use_cache)
         if output:
-            with open(output, 'w') as f:
-                f.write(result)
+            # Write to a temporary file that replaces the output file only once the whole script
+            # has been generated, so that an error never leaves an empty or partial output file
+            tmp_output = f"{output}.tmp"
+            try:
+                with open(tmp_output, 'w') as f:
+                    for line in lines:
+                        f.write(line)
+                        f.write("\n")
+                os.replace(tmp_output, output)
+            except BaseException:
+                if os.path.exists(tmp_output):
+                    os.remove(tmp_output)
+                raise
             print(f"Output written to {output}")
         else:
-            print(result)
+            for line in lines:
+                print(line)
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
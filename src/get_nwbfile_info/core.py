@@ -1,95 +1,453 @@
 """Core functionality for analyzing NWB files."""
 
-from typing import List
+from typing import Any, Callable, Collection, FrozenSet, Iterator, NamedTuple, Optional
+import atexit
+import contextlib
+import functools
+import hashlib
+import itertools
+import os
+import re
 import warnings
 import numpy as np
 import h5py
-import pynwb
-import hdmf
 from datetime import datetime
-from collections.abc import Iterable
-from hdmf.common import DynamicTable
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Mapping
 
 # Limit the number of fields in a dict-like object to show
 # For example, see: get-nwbfile-info usage-script https://api.dandiarchive.org/api/assets/65a7e913-45c7-48db-bf19-b9f5e910110a/download/
 MAX_NUM_FIELDS_TO_SHOW = 8
 
+# Do not show the first few values of a chunked dataset whose chunks have more elements than this.
+# HDF5 reads (and decompresses) the whole chunk even when only a few values are requested.
+PREVIEW_CHUNK_LIMIT = 4096
+
+# Size in bytes of the blocks fetched when reading remote files through fsspec.
+# Can be overridden with the GET_NWBFILE_INFO_BLOCK_SIZE environment variable.
+REMOTE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Settings of the HDF5 raw data chunk cache and metadata cache used when opening
+# HDF5 files. The number of chunk cache slots should be a prime number.
+HDF5_CHUNK_CACHE_NBYTES = 128 * 1024 * 1024
+HDF5_CHUNK_CACHE_NSLOTS = 100003
+HDF5_CHUNK_CACHE_W0 = 0.75
+HDF5_METADATA_CACHE_MAX_SIZE = 64 * 1024 * 1024
+HDF5_METADATA_CACHE_MIN_SIZE = 16 * 1024 * 1024
+
+# Number of remote NWB files kept open between calls, so that repeated calls for the same URL
+# do not re-read the HDF5 metadata and re-parse the NWB schema (see _open_nwb)
+OPEN_REMOTE_FILES_CACHE_SIZE = 8
+
+# Directory in which generated scripts are cached when use_cache is True.
+# Can be set with the GET_NWBFILE_INFO_RESULT_CACHE_DIR environment variable.
+RESULT_CACHE_DIR = os.environ.get(
+    "GET_NWBFILE_INFO_RESULT_CACHE_DIR",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "get-nwbfile-info", "scripts"),
+)
+
+# Cache of type -> name used by get_type_name
+_TYPE_NAME_CACHE = {}
+
 def get_type_name(obj):
     """Get a string representation of the object's type."""
     if obj is None:
         return "None"
 
-    if hasattr(obj, "__class__"):
-        return obj.__class__.__name__
-
-    return str(type(obj))
+    obj_type = type(obj)
+    name = _TYPE_NAME_CACHE.get(obj_type)
+    if name is None:
+        name = obj_type.__name__
+        _TYPE_NAME_CACHE[obj_type] = name
+    return name
+
+def _classify_sequence(value):
+    """Return (is_small, all_str) for a list or tuple, iterating over it only once."""
+    if len(value) >= 10:
+        return False, False
+    all_str = True
+    for item in value:
+        # Most items are scalars, which are small without a call to is_small_value. Only other
+        # items (e.g. nested lists or arrays) are checked recursively.
+        if type(item) not in _SMALL_SCALAR_TYPES and not is_small_value(item):
+            return False, False
+        if all_str and not isinstance(item, str):
+            all_str = False
+    return True, all_str
+
+def _is_small_sequence(value):
+    return _classify_sequence(value)[0]
+
+def _is_small_ndarray(value):
+    return value.size < 10
+
+def _always_small(value):
+    return True
+
+# Checks for whether a value is small, looked up by the exact type of the value.
+# Subclasses of these types are handled by _SMALL_VALUE_CHECKS_BY_BASE.
+_SMALL_VALUE_CHECKS = {
+    type(None): _always_small,
+    str: _always_small,
+    int: _always_small,
+    float: _always_small,
+    bool: _always_small,
+    datetime: _always_small,
+    list: _is_small_sequence,
+    tuple: _is_small_sequence,
+    np.ndarray: _is_small_ndarray,
+}
+
+# Types that are always small, checked by exact type
+_SMALL_SCALAR_TYPES = frozenset({type(None), str, int, float, bool, datetime})
+
+# Same checks as above, in the order they are tried with isinstance. numpy
+# scalars (float64 etc.) are the most common subclass case in NWB files.
+_SMALL_VALUE_CHECKS_BY_BASE = (
+    ((str, int, float, bool), _always_small),
+    (np.ndarray, _is_small_ndarray),
+    (datetime, _always_small),
+    ((list, tuple), _is_small_sequence),
+)
 
 def is_small_value(value):
     """Determine if a value is small enough to be displayed as a comment."""
-    if value is None:
-        return True
+    check = _SMALL_VALUE_CHECKS.get(type(value))
+    if check is not None:
+        return check(value)
 
-    # Handle basic types
-    if isinstance(value, (str, int, float, bool)):
-        return True
+    for base_types, check in _SMALL_VALUE_CHECKS_BY_BASE:
+        if isinstance(value, base_types):
+            return check(value)
 
-    # Handle datetime
-    if isinstance(value, datetime):
-        return True
-
-    # Handle lists, tuples, etc. if they're small
-    if isinstance(value, (list, tuple)) and len(value) < 10:
-        return all(is_small_value(item) for item in value)
+    return False
 
-    # Handle numpy arrays if they're small
-    if isinstance(value, np.ndarray) and value.size < 10:
-        return True
+@functools.lru_cache(maxsize=1024)
+def _shape_dtype_description(shape: tuple, dtype) -> str:
+    # Cached because many datasets and arrays in an NWB file share a shape and dtype
+    return f"shape {shape}; dtype {dtype}"
+
+def _format_none(value):
+    return "None"
+
+def _format_str(value):
+    # Replace newlines with actual newline characters in the comment. Only the first 101
+    # characters can appear in the result (escaping only makes the string longer), so long
+    # strings are cut before they are scanned.
+    formatted = value[:101].replace("\n", "\\n")
+    if len(formatted) > 100:
+        return formatted[:97] + "..."
+    return formatted
+
+def _format_datetime(value):
+    return value.isoformat()
+
+def _format_sequence(value, all_str=None):
+    if len(value) == 0:
+        return "[]"
+    if all_str is None:
+        all_str = all(isinstance(item, str) for item in value)
+    if all_str:
+        return f"[{', '.join(repr(item) for item in value)}]"
+    return str(value)
 
-    return False
+def _format_ndarray(value):
+    if value.size == 0:
+        return f"Empty array with shape {value.shape}"
+    if value.size < 10:
+        return str(value)
+    return "Array with " + _shape_dtype_description(value.shape, value.dtype)
+
+# Formatters looked up by the exact type of the value.
+# Subclasses of these types are handled by _FORMATTERS_BY_BASE.
+_FORMATTERS = {
+    type(None): _format_none,
+    str: _format_str,
+    int: str,
+    float: str,
+    bool: str,
+    datetime: _format_datetime,
+    list: _format_sequence,
+    tuple: _format_sequence,
+    np.ndarray: _format_ndarray,
+}
+
+# Same formatters as above, in the order they are tried with isinstance
+_FORMATTERS_BY_BASE = (
+    (str, _format_str),
+    (datetime, _format_datetime),
+    ((list, tuple), _format_sequence),
+    (np.ndarray, _format_ndarray),
+)
 
 def format_value(value):
     """Format a value for display in a comment."""
-    if value is None:
-        return "None"
+    formatter = _FORMATTERS.get(type(value))
+    if formatter is not None:
+        return formatter(value)
 
-    if isinstance(value, str):
-        # Replace newlines with actual newline characters in the comment
-        formatted = value.replace("\n", "\\n")
-        if len(formatted) > 100:
-            return formatted[:97] + "..."
-        return formatted
+    for base_types, formatter in _FORMATTERS_BY_BASE:
+        if isinstance(value, base_types):
+            return formatter(value)
 
-    if isinstance(value, datetime):
-        return value.isoformat()
+    return str(value)
+
+def format_small_value(value) -> Optional[str]:
+    """
+    Format a value for display in a comment, or return None if it is not small enough to be displayed.
 
+    Equivalent to format_value(value) if is_small_value(value) else None, but lists and tuples are
+    only iterated over once.
+    """
     if isinstance(value, (list, tuple)):
-        if len(value) == 0:
-            return "[]"
-        if all(isinstance(item, str) for item in value):
-            return f"[{', '.join(repr(item) for item in value)}]"
-        return str(value)
+        is_small, all_str = _classify_sequence(value)
+        return _format_sequence(value, all_str) if is_small else None
+    if not is_small_value(value):
+        return None
+    return format_value(value)
+
+# Commented-out code for accessing an h5py dataset, keyed by the number of
+# dimensions (3 is used for 3 or more dimensions)
+_DATASET_ACCESS_TEMPLATES = {
+    1: (
+        "# %s[:] # Access all data",
+        "# %s[0:n] # Access first n elements",
+    ),
+    2: (
+        "# %s[:, :] # Access all data",
+        "# %s[0:n, :] # Access first n rows",
+        "# %s[:, 0:n] # Access first n columns",
+    ),
+    3: (
+        "# %s[:, :, :] # Access all data",
+        "# %s[0, :, :] # Access first plane",
+    ),
+}
+
+class DatasetSummary(NamedTuple):
+    """The metadata of an h5py dataset used to describe it."""
+    type_name: str
+    shape: tuple
+    dtype: np.dtype
+    size: int
+    chunks: Optional[tuple]
+    # Whether the data is compressed with the Blosc2 filter, for which b2h5py can read slices faster
+    blosc2: bool
+
+# Registered HDF5 filter id of Blosc2
+_BLOSC2_FILTER_ID = 32026
+
+def get_dataset_summary(dataset: h5py.Dataset) -> DatasetSummary:
+    """
+    Read the metadata of an h5py dataset once.
 
-    if isinstance(value, np.ndarray):
-        if value.size == 0:
-            return f"Empty array with shape {value.shape}"
-        if value.size < 10:
-            return str(value)
-        return f"Array with shape {value.shape}; dtype {value.dtype}"
+    Each property access on an h5py dataset queries HDF5 (for example, h5py.Dataset.size re-reads
+    the shape), so they are gathered here once per dataset. Datasets with a null dataspace are
+    reported with shape () and size 0. Only chunked datasets can have filters, so the filter
+    pipeline is only inspected for those.
+    """
+    shape = dataset.shape
+    if shape is None:
+        shape = ()
+        size = 0
+    else:
+        size = int(np.prod(shape))
+    chunks = dataset.chunks
+    blosc2 = False
+    if chunks is not None:
+        dcpl = dataset.id.get_create_plist()
+        blosc2 = any(dcpl.get_filter(i)[0] == _BLOSC2_FILTER_ID for i in range(dcpl.get_nfilters()))
+    return DatasetSummary(
+        type_name=get_type_name(dataset),
+        shape=shape,
+        dtype=dataset.dtype,
+        size=size,
+        chunks=chunks,
+        blosc2=blosc2,
+    )
+
+class SampleRequest(NamedTuple):
+    """A deferred read of a small sample of an h5py dataset."""
+    expression: str
+    prefix: str
+    dataset: h5py.Dataset
+    slicer: tuple
+    summary: DatasetSummary
+
+def _read_sample(request: SampleRequest):
+    dataset = request.dataset
+    summary = request.summary
+    # Chunked datasets are sliced, so that only the chunks holding the sample are read. For
+    # Blosc2-compressed datasets, b2h5py's optimized slicing is enabled for just this read, since
+    # it patches h5py.Dataset for the whole process.
+    if summary.blosc2:
+        with _blosc2_fast_slicing():
+            return dataset[request.slicer]
+    if summary.chunks is not None:
+        return dataset[request.slicer]
+    # Samples are only taken from tiny datasets, and a contiguous dataset is stored as a single
+    # block, so read all of it with one selection-free read and slice the sample in memory. Numeric
+    # data is read directly into a new buffer, bypassing h5py's high-level selection machinery.
+    # Strings go through [()] because hdmf's StrDataset decodes them on read.
+    if type(dataset) is h5py.Dataset and summary.dtype.kind in "biufc":
+        data = np.empty(summary.shape, dtype=summary.dtype)
+        dataset.read_direct(data)
+    else:
+        data = dataset[()]
+    return data[request.slicer]
 
-    return str(value)
+def read_sample_requests(results: Iterable, read_chunked: bool = True) -> Iterator[str]:
+    """
+    Execute the deferred SampleRequest entries in results and yield the lines with the formatted samples spliced in.
+
+    The reads are done in order as the lines are yielded. They are not done concurrently, since
+    h5py holds its global lock for the whole of each read, including while the file driver fetches
+    bytes from a remote file. Requests that fail are dropped, and a single warning summarizing the
+    failures is issued at the end.
+
+    If read_chunked is False, requests for chunked datasets are dropped without being read, since
+    reading a few values fetches (and decompresses) whole chunks.
+    """
+    errors = []
+    for item in results:
+        if not isinstance(item, SampleRequest):
+            yield item
+            continue
+        if not read_chunked and item.summary.chunks is not None:
+            continue
+        try:
+            sample = _read_sample(item)
+        except Exception as e:
+            errors.append((item.expression, e))
+            continue
+        yield f"{item.prefix}{sample}".replace("\n", " ")
+
+    if len(errors) == 1:
+        warnings.warn(f"Could not read data from {errors[0][0]}: {errors[0][1]}")
+    elif errors:
+        warnings.warn(f"Could not read data from {len(errors)} datasets, including {errors[0][0]}: {errors[0][1]}")
+
+class WalkItem(NamedTuple):
+    """A pending node in the depth-first walk done by process_nwb_container."""
+    kind: str  # "object" or "dict_like"
+    obj: Any
+    expression: str
+    variable_names_in_scope: FrozenSet[str]
+    # The expression rooted at the walk's root, without the variables bound along the way
+    full_expression: str
+
+def process_nwb_container(obj, *, expression: str, variable_names_in_scope: Iterable[str]):
+    """
+    Process an NWB container and yield lines of Python code to access its fields.
 
-def process_dict_like(obj, *, expression: str, variable_names_in_scope: List[str]):
+    The tree is walked depth-first using an explicit stack rather than recursion, so that large
+    NWB files do not pay a Python stack frame and a list copy per node or hit the recursion limit.
+    Sample values of small datasets are read as their lines are reached (see read_sample_requests).
     """
-    Process dictionary-like objects (including LabelledDict) and generate Python code to access their items.
+    yield from read_sample_requests(_walk(WalkItem("object", obj, expression, frozenset(variable_names_in_scope), expression)))
+
+def process_dict_like(obj, *, expression: str, variable_names_in_scope: Iterable[str]):
+    """
+    Process dictionary-like objects (including LabelledDict) and yield lines of Python code to access their items.
+    """
+    yield from read_sample_requests(_walk(WalkItem("dict_like", obj, expression, frozenset(variable_names_in_scope), expression)))
+
+class _EndOfPath(NamedTuple):
+    """Marker pushed below the children of a node; popping it means the walk has left the node."""
+    key: tuple
+
+# hdmf classes used by the walk. hdmf is slow to import, so they are only imported when the first
+# walk starts (see _import_hdmf_classes).
+_ABSTRACT_CONTAINER = None
+_DYNAMIC_TABLE = None
+_VECTOR_INDEX = None
+
+def _import_hdmf_classes():
+    global _ABSTRACT_CONTAINER, _DYNAMIC_TABLE, _VECTOR_INDEX
+    from hdmf.common import DynamicTable, VectorIndex
+    from hdmf.container import AbstractContainer
+    _ABSTRACT_CONTAINER = AbstractContainer
+    _DYNAMIC_TABLE = DynamicTable
+    _VECTOR_INDEX = VectorIndex
+
+def _walk(root: WalkItem) -> Iterator:
+    """Walk the tree rooted at root depth-first and yield the generated lines in order."""
+    if _ABSTRACT_CONTAINER is None:
+        _import_hdmf_classes()
+
+    stack = [root]
+    # Buffer reused for the children of each node
+    children = []
+    # (kind, id) of the nodes on the path from the root to the current node. Only back-edges along
+    # this path can cause infinite loops, so dict-like and iterable objects shared between different
+    # branches are still shown once for each place they are referenced from. Containers are only
+    # shown once in all (see shown_containers).
+    on_path = set()
+    # Containers shown so far, keyed by identity, mapped to the expression they were shown at. A
+    # container referenced from several places (for example, the electrodes table is also the
+    # table of each electrodes DynamicTableRegion) is only expanded the first time. The expression
+    # is the full one from the root, since the variables of the generated script are rebound in
+    # other branches. The type name and name are part of the key in case an id is reused.
+    shown_containers = {}
+    # Expressions of the containers shown so far. Each container should be reachable by a
+    # distinct expression, so a repeat indicates a problem with the generated code.
+    seen_expressions = set()
+    found_duplicates = False
+    while stack:
+        item = stack.pop()
+        if isinstance(item, _EndOfPath):
+            on_path.discard(item.key)
+            continue
+        if not isinstance(item, WalkItem):
+            yield item
+            continue
+
+        # The kind is part of the key because an "object" node for a dict is expanded into a
+        # "dict_like" node for the same dict
+        key = (item.kind, id(item.obj))
+        if key in on_path:
+            # The object contains itself; do not descend again
+            continue
+
+        if item.kind == "object" and isinstance(item.obj, _ABSTRACT_CONTAINER):
+            container_key = (id(item.obj), type(item.obj).__name__, getattr(item.obj, "name", None))
+            first_expression = shown_containers.get(container_key)
+            if first_expression is not None:
+                yield f"# {item.expression} -> already shown at {first_expression}"
+                continue
+            shown_containers[container_key] = item.full_expression
+
+            if item.expression in seen_expressions:
+                found_duplicates = True
+            else:
+                seen_expressions.add(item.expression)
+
+        children.clear()
+        if item.kind == "dict_like":
+            _expand_dict_like(item.obj, children, expression=item.expression, variable_names_in_scope=item.variable_names_in_scope, full_expression=item.full_expression)
+        else:
+            _expand_object(item.obj, children, expression=item.expression, variable_names_in_scope=item.variable_names_in_scope, full_expression=item.full_expression)
+
+        if any(isinstance(child, WalkItem) for child in children):
+            on_path.add(key)
+            stack.append(_EndOfPath(key))
+        # Push in reverse so that the children are emitted in their original order
+        stack.extend(reversed(children))
+
+    if found_duplicates:
+        warnings.warn("Warning: Duplicate entries found in the results.")
+
+def _expand_dict_like(obj, results: list, *, expression: str, variable_names_in_scope: FrozenSet[str], full_expression: str):
+    """
+    Append the lines for a dictionary-like object to results, with a WalkItem in place of each value to descend into.
     """
-    results = []
     num_shown_fields = 0
     unshown_field_names = []
 
     # Try to iterate through items
     for key, value in obj.items():
         # Skip private keys
-        if isinstance(key, str) and key.startswith('_'):
+        if isinstance(key, str) and key[:1] == '_':
             continue
 
         if num_shown_fields >= MAX_NUM_FIELDS_TO_SHOW:
@@ -102,19 +460,21 @@ def process_dict_like(obj, *, expression: str, variable_names_in_scope: List[str
         # Format the path based on the key type
         if isinstance(key, str):
             item_expr = f"{expression}[\"{key}\"]"
+            item_full_expr = f"{full_expression}[\"{key}\"]"
         else:
             item_expr = f"{expression}[{key}]"
+            item_full_expr = f"{full_expression}[{key}]"
 
-        # AbstractContainer objects will be printed later in recursion
-        if not isinstance(value, hdmf.container.AbstractContainer):
+        # AbstractContainer objects will be printed later in the walk
+        if not isinstance(value, _ABSTRACT_CONTAINER):
             type_name = get_type_name(value)
         else:
             type_name = ""
 
-        # Recursively process the value
+        # Descend into the value
         item_variable = get_variable_name_for_string(key, variable_names_in_scope)
         if item_variable:
-            variable_names_in_scope_2 = variable_names_in_scope + [item_variable]
+            variable_names_in_scope_2 = variable_names_in_scope | {item_variable}
             if type_name:
                 results.append(f"{item_variable} = {item_expr} # ({type_name})")
             else:
@@ -124,7 +484,7 @@ def process_dict_like(obj, *, expression: str, variable_names_in_scope: List[str
             results.append(f"{item_expr} # ({type_name})")
             variable_names_in_scope_2 = variable_names_in_scope
             item_expr_2 = item_expr
-        results.extend(process_nwb_container(value, expression=item_expr_2, variable_names_in_scope=variable_names_in_scope_2))
+        results.append(WalkItem("object", value, item_expr_2, variable_names_in_scope_2, item_full_expr))
 
         num_shown_fields += 1
 
@@ -134,136 +494,327 @@ def process_dict_like(obj, *, expression: str, variable_names_in_scope: List[str
         if len(unshown_field_names) > 15:
             results.append(f"# ... and {len(unshown_field_names) - 15} more fields")
 
-        num_shown_fields += 1
-
-    return results
-
-def process_nwb_container(obj, *, expression: str, variable_names_in_scope: List[str]):
+def _expand_object(obj, results: list, *, expression: str, variable_names_in_scope: FrozenSet[str], full_expression: str):
     """
-    Recursively process an NWB container and generate Python code to access its fields.
+    Append the lines for an NWB container (or other object) to results, with a WalkItem in place of each child to descend into.
     """
-    results = []
-
     # Process NWBContainer or NWBData objects
-    if isinstance(obj, hdmf.container.AbstractContainer):
+    if isinstance(obj, _ABSTRACT_CONTAINER):
         # Add a comment about the object type
         type_name = get_type_name(obj)
         results.append(f"{expression} # ({type_name})")
 
-        # Get all field names upfront and filter out private ones
-        field_names = [name for name in obj.fields.keys() if not name.startswith('_')]
+        # Process the fields in a single pass. Non-container fields are shown
+        # first; container fields are collected and descended into afterwards.
+        container_items = []
+        for field_name, field_value in obj.fields.items():
+            # Skip private fields
+            if field_name[:1] == '_':
+                continue
 
-        # Split fields into non-container and container fields
-        non_container_fields = []
-        container_fields = []
-        for name in field_names:
-            if isinstance(obj.fields[name], hdmf.container.AbstractContainer):
-                container_fields.append(name)
-            else:
-                non_container_fields.append(name)
-
-        # Process non-container fields
-        for field_name in non_container_fields:
-            field_value = obj.fields[field_name]
             field_expr = f"{expression}.{field_name}"
 
+            if isinstance(field_value, _ABSTRACT_CONTAINER):
+                container_items.append(WalkItem("object", field_value, field_expr, variable_names_in_scope, f"{full_expression}.{field_name}"))
+                continue
+
             # Add the field with a comment if the value is small
             if isinstance(field_value, h5py.Dataset):
+                summary = get_dataset_summary(field_value)
+                shape = summary.shape
+                ndim = len(shape)
+
                 # Add basic dataset info
-                results.append(f"{field_expr} # ({get_type_name(field_value)}) shape {field_value.shape}; dtype {field_value.dtype}")
+                results.append("%s # (%s) %s" % (field_expr, summary.type_name, _shape_dtype_description(shape, summary.dtype)))
 
                 # Always add code to access the dataset
                 # But comment it out because we don't want to actually download
                 # the data if we run the script for testing.
-                if len(field_value.shape) == 1:
-                    results.append(f"# {field_expr}[:] # Access all data")
-                    results.append(f"# {field_expr}[0:n] # Access first n elements")
-                elif len(field_value.shape) == 2:
-                    results.append(f"# {field_expr}[:, :] # Access all data")
-                    results.append(f"# {field_expr}[0:n, :] # Access first n rows")
-                    results.append(f"# {field_expr}[:, 0:n] # Access first n columns")
-                elif len(field_value.shape) >= 3:
-                    results.append(f"# {field_expr}[:, :, :] # Access all data")
-                    results.append(f"# {field_expr}[0, :, :] # Access first plane")
-
-                # Try to read and display small datasets in comments
-                try:
-                    if field_value.size < 50:  # type: ignore
-                        # Only for reasonably small datasets
-                        # For 1D datasets
-                        if len(field_value.shape) == 1 and field_value.shape[0] > 0:
-                            sample = field_value[:min(10, field_value.shape[0])]
-                            results.append(f"# First few values of {field_expr}: {sample}".replace("\n", " "))
-                        # For 2D datasets
-                        elif len(field_value.shape) == 2 and field_value.shape[0] > 0 and field_value.shape[1] > 0:
-                            sample = field_value[0, :min(10, field_value.shape[1])]
-                            results.append(f"# First row sample of {field_expr}: {sample}".replace("\n", " "))
-                except Exception as e:
-                    warnings.warn(f"Could not read data from {field_expr}: {e}")
-            elif is_small_value(field_value):  # non-h5py.Dataset
-                type_name = get_type_name(field_value)
-                value_str = format_value(field_value)
-                results.append(f"{field_expr} # ({type_name}) {value_str}")
+                if ndim >= 1:
+                    results.extend(template % field_expr for template in _DATASET_ACCESS_TEMPLATES[min(ndim, 3)])
+
+                # Display small datasets in comments. The reads are deferred to
+                # read_sample_requests, which can drop them (e.g. for remote files)
+                chunks = summary.chunks
+                if summary.size < 50 and (chunks is None or int(np.prod(chunks)) <= PREVIEW_CHUNK_LIMIT):
+                    # Only for reasonably small datasets
+                    # For 1D datasets
+                    if ndim == 1 and shape[0] > 0:
+                        results.append(SampleRequest(
+                            expression=field_expr,
+                            prefix=f"# First few values of {field_expr}: ",
+                            dataset=field_value,
+                            slicer=np.s_[:min(10, shape[0])],
+                            summary=summary,
+                        ))
+                    # For 2D datasets
+                    elif ndim == 2 and shape[0] > 0 and shape[1] > 0:
+                        results.append(SampleRequest(
+                            expression=field_expr,
+                            prefix=f"# First row sample of {field_expr}: ",
+                            dataset=field_value,
+                            slicer=np.s_[0, :min(10, shape[1])],
+                            summary=summary,
+                        ))
             else:
                 type_name = get_type_name(field_value)
-                results.append(f"{field_expr} # ({type_name})")
+                value_str = format_small_value(field_value)  # non-h5py.Dataset
+                if value_str is not None:
+                    results.append(f"{field_expr} # ({type_name}) {value_str}")
+                else:
+                    results.append(f"{field_expr} # ({type_name})")
 
-            # Special handling for LabelledDict objects
-            if isinstance(field_value, hdmf.utils.LabelledDict):
+            # Special handling for dict-like objects (e.g., LabelledDict)
+            if isinstance(field_value, Mapping):
                 variable_name = get_variable_name_for_string(field_name, variable_names_in_scope)
                 if variable_name:
                     results.append(f"{variable_name} = {field_expr}")
                     field_expr_2 = variable_name
-                    variable_names_in_scope_2 = variable_names_in_scope + [variable_name]
+                    variable_names_in_scope_2 = variable_names_in_scope | {variable_name}
                 else:
                     field_expr_2 = field_expr
                     variable_names_in_scope_2 = variable_names_in_scope
-                results.extend(process_dict_like(field_value, expression=field_expr_2, variable_names_in_scope=variable_names_in_scope_2))
-
-        # Process container fields
-        for field_name in container_fields:
-            field_value = obj.fields[field_name]
-            field_expr = f"{expression}.{field_name}"
+                results.append(WalkItem("dict_like", field_value, field_expr_2, variable_names_in_scope_2, f"{full_expression}.{field_name}"))
 
-            # Recursively process the field value
-            results.extend(process_nwb_container(field_value, expression=field_expr, variable_names_in_scope=variable_names_in_scope))
+        # Descend into the container fields
+        results.extend(container_items)
 
         # Special handling for DynamicTable objects
-        if isinstance(obj, DynamicTable):
-            # Comment the dataframe code out because we don't want to download data if we run the script for testing
-            results.append(f"# {expression}.to_dataframe() # (DataFrame) Convert to a pandas DataFrame with {len(obj)} rows and {len(obj.columns)} columns")  # type: ignore
-            results.append(f"# {expression}.to_dataframe().head() # (DataFrame) Show the first few rows of the pandas DataFrame")
-            # show each of the columns
-            for colname in obj.colnames:  # type: ignore
-                results.append(f"{expression}.{colname} # ({get_type_name(obj[colname])}) {obj[colname].description}")  # type: ignore
-                if get_type_name(obj[colname]) == "VectorIndex":  # type: ignore
-                    for j in range(len(obj[colname + "_index"])):  # type: ignore
-                        if j <= 3:
-                            results.append(f"# {expression}.{colname}_index[{j}] # ({get_type_name(obj[colname+'_index'][j])})")  # type: ignore
-                    if len(obj[colname + "_index"]) > 3:  # type: ignore
-                        results.append(f"# ...")
+        if isinstance(obj, _DYNAMIC_TABLE):
+            # A malformed table should not stop the rest of the file from being shown, so any
+            # error while listing its columns is reported as a single warning
+            try:
+                # Comment the dataframe code out because we don't want to download data if we run the script for testing
+                num_rows = len(obj)
+                columns = obj.columns
+                results.append(f"# {expression}.to_dataframe() # (DataFrame) Convert to a pandas DataFrame with {num_rows} rows and {len(columns)} columns")
+                results.append(f"# {expression}.to_dataframe().head() # (DataFrame) Show the first few rows of the pandas DataFrame")
+                # show each of the columns. The column objects (including the VectorIndex objects of
+                # ragged columns) are looked up rather than fetched through DynamicTable.__getitem__.
+                # Each VectorIndex is found through its target, not by name, since a plain column
+                # may also be named "<column>_index".
+                columns_by_name = {column.name: column for column in columns}
+                index_by_target = {column.target.name: column for column in columns if isinstance(column, _VECTOR_INDEX)}
+                for colname in obj.colnames:  # type: ignore
+                    # Like obj[colname], use the outermost VectorIndex of a ragged column
+                    column = columns_by_name[colname]
+                    while column.name in index_by_target:
+                        column = index_by_target[column.name]
+                    results.append(f"{expression}.{colname} # ({get_type_name(column)}) {column.description}")
+                    if isinstance(column, _VECTOR_INDEX):
+                        index = index_by_target[colname]
+                        num_index_rows = len(index)  # type: ignore
+                        # Read the shown rows one at a time: slicing a VectorIndex loads the whole
+                        # target column before cutting the rows out of it
+                        for j in range(min(num_index_rows, 4)):
+                            results.append(f"# {expression}.{colname}_index[{j}] # ({get_type_name(index[j])})")  # type: ignore
+                        if num_index_rows > 3:
+                            results.append(f"# ...")
+            except Exception as e:
+                warnings.warn(f"Could not list the columns of {expression}: {e}")
 
 
     # Process dictionaries and dict-like objects
-    elif isinstance(obj, dict) or (hasattr(obj, "items") and callable(getattr(obj, "items"))):
-        results.extend(process_dict_like(obj, expression=expression, variable_names_in_scope=variable_names_in_scope))
+    elif isinstance(obj, Mapping):
+        results.append(WalkItem("dict_like", obj, expression, variable_names_in_scope, full_expression))
 
     # Process iterables (excluding strings)
     elif isinstance(obj, Iterable) and not isinstance(obj, (str, dict, h5py.Dataset)):
         try:
-            for i, item in enumerate(obj):
+            # Take one item past the limit to know whether there are more, without
+            # advancing lazy iterables any further
+            for i, item in enumerate(itertools.islice(obj, 11)):
                 if i >= 10:  # Limit to first 10 items
                     results.append(f"# ... more items in {expression}")
                     break
 
                 item_expr = f"{expression}[{i}]"
-                results.extend(process_nwb_container(item, expression=item_expr, variable_names_in_scope=variable_names_in_scope))
+                results.append(WalkItem("object", item, item_expr, variable_names_in_scope, f"{full_expression}[{i}]"))
         except Exception as e:
             warnings.warn(f"Could not iterate through {expression}: {e}")
 
-    return results
+# Expressions for NWB file locations that are exposed as attributes of the NWBFile
+_NWB_PATH_EXPRESSIONS = {
+    "general/subject": "subject",
+    "general/extracellular_ephys/electrodes": "electrodes",
+    "intervals/trials": "trials",
+    "intervals/epochs": "epochs",
+    "units": "units",
+}
+
+# Expressions for NWB groups whose members are accessed by name
+_NWB_COLLECTION_EXPRESSIONS = {
+    "acquisition": "acquisition",
+    "analysis": "analysis",
+    "processing": "processing",
+    "intervals": "intervals",
+    "stimulus/presentation": "stimulus",
+    "stimulus/templates": "stimulus_template",
+    "general/devices": "devices",
+    "general/extracellular_ephys": "electrode_groups",
+    "general/intracellular_ephys": "icephys_electrodes",
+    "general/optophysiology": "imaging_planes",
+    "general/optogenetics": "ogen_sites",
+    "general/lab_meta_data": "lab_meta_data",
+}
+
+def get_expression_for_hdf5_path(path: str, *, expression: str = "nwb", typed_groups: Collection[str] = ()) -> str:
+    """
+    Approximate the PyNWB expression for the object at an HDF5 path in an NWB file.
+
+    Known NWBFile locations are mapped to their attributes, members of known collections are
+    accessed by name, and other locations under "general" are treated as attributes of the NWBFile.
+    Members of processing modules are accessed by name, since ProcessingModule supports indexing.
+    Below that, groups whose HDF5 paths are in typed_groups (those carrying a neurodata_type
+    attribute) are accessed by name, as the members of data interfaces such as LFP or Fluorescence
+    are, and everything else is accessed as attributes.
+    """
+    parts = path.strip("/").split("/")
+
+    # Find the longest prefix of the path that is a known location
+    for i in range(len(parts), 0, -1):
+        prefix = "/".join(parts[:i])
+        if prefix in _NWB_PATH_EXPRESSIONS:
+            expr = f"{expression}.{_NWB_PATH_EXPRESSIONS[prefix]}"
+            rest = parts[i:]
+            break
+        if prefix in _NWB_COLLECTION_EXPRESSIONS:
+            expr = f"{expression}.{_NWB_COLLECTION_EXPRESSIONS[prefix]}"
+            rest = parts[i:]
+            if rest:
+                expr += f"[\"{rest[0]}\"]"
+                rest = rest[1:]
+            if prefix == "processing" and rest:
+                expr += f"[\"{rest[0]}\"]"
+                rest = rest[1:]
+            break
+    else:
+        expr = expression
+        rest = parts[1:] if parts[0] == "general" and len(parts) > 1 else parts
+
+    path = "/".join(parts[:len(parts) - len(rest)])
+    for part in rest:
+        path = f"{path}/{part}" if path else part
+        # The NWBFile itself does not support indexing
+        if expr != expression and path in typed_groups:
+            expr += f"[\"{part}\"]"
+        else:
+            expr += f".{part}"
+    return expr
+
+def process_hdf5_file(h5_file, *, expression: str = "nwb"):
+    """
+    Yield lines of Python code to access the groups and datasets of an NWB file, using the HDF5 tree directly.
 
-def get_nwbfile_usage_script(url_or_path):
+    This walks the HDF5 tree directly rather than reading it with PyNWB, which is much faster for
+    large files because no PyNWB containers are built. The expressions are derived from the HDF5
+    paths by get_expression_for_hdf5_path. Sample values of datasets are not shown.
+    """
+    # Walk the tree in the same order as h5py's visititems (pre-order, by name,
+    # following hard links only and visiting each object once), but with an
+    # explicit stack so that lines are yielded as they are produced
+    seen = {h5_file.id}
+    # HDF5 paths of the groups with a neurodata_type, for get_expression_for_hdf5_path. Groups
+    # are visited before their members, so each member's parent is already recorded.
+    typed_groups = set()
+    stack = [("", h5_file, iter(sorted(h5_file)))]
+    while stack:
+        prefix, group, keys = stack[-1]
+        key = next(keys, None)
+        if key is None:
+            stack.pop()
+            continue
+        if not isinstance(group.get(key, getlink=True), h5py.HardLink):
+            continue
+        obj = group[key]
+        if obj.id in seen:
+            continue
+        seen.add(obj.id)
+        name = prefix + key
+        # The cached specifications are not part of the NWB data, and the
+        # "general" and "stimulus" groups themselves have no counterpart in PyNWB
+        is_group = isinstance(obj, h5py.Group)
+        if is_group:
+            neurodata_type = obj.attrs.get("neurodata_type")
+            if isinstance(neurodata_type, bytes):
+                neurodata_type = neurodata_type.decode()
+            if neurodata_type is not None:
+                typed_groups.add(name)
+        if name not in ("general", "stimulus", "specifications") and not name.startswith("specifications/"):
+            obj_expr = get_expression_for_hdf5_path(name, expression=expression, typed_groups=typed_groups)
+            if is_group:
+                yield f"{obj_expr} # ({neurodata_type or 'Group'})"
+            else:
+                yield from _hdf5_dataset_lines(obj, obj_expr)
+        if is_group:
+            stack.append((name + "/", obj, iter(sorted(obj))))
+
+
+def _hdf5_dataset_lines(dataset: h5py.Dataset, obj_expr: str):
+    summary = get_dataset_summary(dataset)
+    shape = summary.shape
+    ndim = len(shape)
+    yield "%s # (%s) %s" % (obj_expr, summary.type_name, _shape_dtype_description(shape, summary.dtype))
+    if ndim >= 1:
+        yield from (template % obj_expr for template in _DATASET_ACCESS_TEMPLATES[min(ndim, 3)])
+
+# Headers of the generated script, showing how to load the file, for each kind
+# of URL or path. Each ends with a blank line.
+_HEADER_REMOTE = """\
+# This script shows how to load the NWB file at {url_or_path} in Python using PyNWB
+
+import pynwb
+import h5py
+import remfile
+
+# Load
+url = "{url_or_path}"
+remote_file = remfile.File(url)
+h5_file = h5py.File(remote_file)
+io = pynwb.NWBHDF5IO(file=h5_file)
+nwb = io.read()
+"""
+
+_HEADER_REMOTE_LINDI = """\
+# This script shows how to load the NWB file at {url_or_path} in Python using PyNWB
+
+import pynwb
+import h5py
+import lindi
+
+# Load
+url = "{url_or_path}"
+f = lindi.LindiH5pyFile.from_lindi_file(url)
+io = pynwb.NWBHDF5IO(file=f, mode='r')
+nwb = io.read()
+"""
+
+_HEADER_LOCAL_LINDI = """\
+# This script shows how to load the NWB file at {url_or_path} in Python using PyNWB
+
+import pynwb
+import h5py
+import lindi
+
+# Load
+path = "{url_or_path}"
+f = lindi.LindiH5pyFile.from_lindi_file(path)
+io = pynwb.NWBHDF5IO(file=f, mode='r')
+nwb = io.read()
+"""
+
+_HEADER_LOCAL = """\
+# This script shows how to load the NWB file at {url_or_path} in Python using PyNWB
+
+import pynwb
+import h5py
+
+# Load
+path = "{url_or_path}"
+nwb = pynwb.read_nwb(path=path)
+"""
+
+def get_nwbfile_usage_script(url_or_path, cache_dir: Optional[str] = None, raw: bool = False, use_cache: bool = False):
     """
     Analyze an NWB file and return Python code to access its objects and fields.
 
@@ -277,6 +828,25 @@ def get_nwbfile_usage_script(url_or_path):
           where [ID] is the dandiset ID, [VERSION] is the version,
           and [path] is the file path within the dandiset
         - .lindi.json or .lindi.tar file path/URL for lindi-formatted files
+    cache_dir : str, optional
+        Directory in which to cache byte ranges fetched from remote files, so
+        that subsequent runs against the same URL avoid network round-trips.
+        By default, nothing is cached on disk.
+    raw : bool, optional
+        If True, list the groups and datasets of the HDF5 file directly instead
+        of reading the file with PyNWB. This is much faster for large files,
+        but the expressions are derived from the HDF5 paths (see
+        process_hdf5_file) and are less accurate. Not supported for Zarr files.
+    use_cache : bool, optional
+        If True, reuse the script generated by a previous call for the same file, as long as the
+        file has not changed since (going by the ETag of a remote file, or the size and
+        modification time of a local file). Scripts are cached in RESULT_CACHE_DIR.
+
+    Notes
+    -----
+    If b2h5py is installed, sample values of Blosc2-compressed datasets are
+    read with its optimized slicing. Set BLOSC2_FILTER=1 in the environment
+    to use the regular HDF5 filter pipeline instead.
 
     Returns
     -------
@@ -298,6 +868,15 @@ def get_nwbfile_usage_script(url_or_path):
     >>> # Lindi file
     >>> script = get_nwbfile_usage_script("path/to/file.lindi.json")
     """
+    return "\n".join(iter_nwbfile_usage_script(url_or_path, cache_dir=cache_dir, raw=raw, use_cache=use_cache))
+
+def iter_nwbfile_usage_script(url_or_path, cache_dir: Optional[str] = None, raw: bool = False, use_cache: bool = False) -> Iterator[str]:
+    """
+    Analyze an NWB file and yield the lines of Python code to access its objects and fields.
+
+    This is the streaming form of get_nwbfile_usage_script, which takes the same arguments. Lines
+    are yielded as the file is walked, so the full script never needs to be held in memory.
+    """
     if url_or_path.startswith("DANDI:"):
         # special case of DANDI:[ID]:[VERSION]:[path]
         parts = url_or_path[len("DANDI:"):].split(":")
@@ -310,126 +889,356 @@ def get_nwbfile_usage_script(url_or_path):
         client = DandiAPIClient()
         dandiset = client.get_dandiset(dandiset_id, dandiset_version)
         dandiset_file_url = dandiset.get_asset_by_path(dandiset_file_path).download_url
-        script0 = get_nwbfile_usage_script(dandiset_file_url)
-        script_lines = str(script0).splitlines()
-        new_script_lines = []
         found1 = False
-        for line in script_lines:
+        for line in iter_nwbfile_usage_script(dandiset_file_url, cache_dir=cache_dir, raw=raw, use_cache=use_cache):
             if line.startswith('# This script shows how to load the NWB file at'):
                 found1 = True
-                new_script_lines.append(
-                    f"# This script shows how to load the NWB file at {dandiset_file_path} in Dandiset {dandiset_id} version {dandiset_version} in Python using PyNWB")
+                yield f"# This script shows how to load the NWB file at {dandiset_file_path} in Dandiset {dandiset_id} version {dandiset_version} in Python using PyNWB"
             elif line.startswith('url = '):
-                new_script_lines.append(
+                yield (
                     f'from dandi.dandiapi import DandiAPIClient\n'
                     f'client = DandiAPIClient()\n'
                     f'dandiset = client.get_dandiset("{dandiset_id}", "{dandiset_version}")\n'
                     f'url = dandiset.get_asset_by_path("{dandiset_file_path}").download_url')
+            elif not found1:
+                raise Exception("Unexpected: could not find a header line in the script")
             else:
-                new_script_lines.append(line)
-        if not found1:
-            raise Exception("Unexpected: could not find a header line in the script")
-        return '\n'.join(new_script_lines)
-
+                yield line
+        return
+
+    lines = _iter_usage_script_lines(url_or_path, cache_dir=cache_dir, raw=raw)
+    if use_cache:
+        cache_path = _get_result_cache_path(url_or_path, raw=raw)
+        if cache_path is not None:
+            lines = _iter_cached_lines(cache_path, lines)
+    yield from lines
+
+def _iter_usage_script_lines(url_or_path: str, cache_dir: Optional[str] = None, raw: bool = False) -> Iterator[str]:
+    """Yield the lines of the usage script for a local path or URL (not a DANDI reference)."""
+    # Header lines
+    header_template = _get_loader(url_or_path).header_template
+    header_lines = header_template.format(url_or_path=url_or_path).split("\n")
+
+    if raw:
+        # Walk the HDF5 tree directly without reading the file with pynwb
+        h5_file = _open_hdf5(url_or_path, cache_dir=cache_dir)
+        if h5_file is None:
+            raise ValueError(f"Raw mode is only supported for HDF5 files: {url_or_path}")
+        try:
+            yield from header_lines
+            yield from process_hdf5_file(h5_file, expression="nwb")
+        finally:
+            h5_file.close()
+        return
+
+    with _open_nwb(url_or_path, cache_dir=cache_dir) as nwb:
+        yield from header_lines
+
+        # Process the NWB file, yielding lines as they are generated. Sample values
+        # of chunked datasets are not shown for remote files, where they would cost
+        # whole chunks fetched over the network.
+        is_remote = url_or_path.startswith(('http://', 'https://'))
+        yield from read_sample_requests(
+            _walk(WalkItem("object", nwb, "nwb", frozenset(), "nwb")),
+            read_chunked=not is_remote,
+        )
+
+
+def _get_file_version(url_or_path: str) -> Optional[str]:
+    """
+    Return a string that changes whenever the file at url_or_path changes, or None if there is no reliable one.
 
-    is_url = url_or_path.startswith(('http://', 'https://'))
-    is_lindi = url_or_path.endswith(('.lindi.json', '.lindi.tar'))
+    For remote files this is the ETag (or Last-Modified and Content-Length) from a HEAD request.
+    For local files it is the size and modification time.
+    """
+    if url_or_path.startswith(('http://', 'https://')):
+        import urllib.request
+
+        class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+            # urllib turns a redirected HEAD request into a GET, which would start downloading
+            # the whole file (DANDI asset URLs redirect to the storage bucket)
+            def redirect_request(self, req, fp, code, msg, headers, newurl):
+                new_request = super().redirect_request(req, fp, code, msg, headers, newurl)
+                if new_request is not None and req.get_method() == "HEAD":
+                    new_request.method = "HEAD"
+                return new_request
+
+        opener = urllib.request.build_opener(HeadRedirectHandler)
+        try:
+            with opener.open(urllib.request.Request(url_or_path, method="HEAD"), timeout=30) as response:
+                headers = response.headers
+        except OSError:
+            return None
+        etag = headers.get("ETag")
+        if etag:
+            return f"etag {etag}"
+        last_modified = headers.get("Last-Modified")
+        content_length = headers.get("Content-Length")
+        if last_modified and content_length:
+            return f"modified {last_modified} length {content_length}"
+        return None
+    if not os.path.isfile(url_or_path):
+        # e.g., a Zarr directory, whose modification time does not cover its contents
+        return None
+    stat = os.stat(url_or_path)
+    return f"size {stat.st_size} mtime {stat.st_mtime_ns}"
+
+def _get_result_cache_path(url_or_path: str, raw: bool) -> Optional[str]:
+    """Return the path at which the script for url_or_path is cached, or None if it cannot be cached."""
+    from . import __version__
+
+    file_version = _get_file_version(url_or_path)
+    if file_version is None:
+        return None
+    key = "\n".join((__version__, url_or_path, "raw" if raw else "nwb", file_version))
+    return os.path.join(RESULT_CACHE_DIR, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".py")
+
+def _iter_cached_lines(cache_path: str, lines: Iterator[str]) -> Iterator[str]:
+    """
+    Yield the lines of the script cached at cache_path if there is one. Otherwise yield from lines,
+    and cache the script once lines is exhausted.
 
-    # Header lines
-    header_lines = [
-        f"# This script shows how to load the NWB file at {url_or_path} in Python using PyNWB",
-        "",
-        "import pynwb",
-        "import h5py"
-    ]
-
-    # Show different loading methods based on URL type
-    if is_url and not is_lindi:
-        header_lines.extend([
-            "import remfile",
-            "",
-            "# Load",
-            f"url = \"{url_or_path}\"",
-            "remote_file = remfile.File(url)",
-            "h5_file = h5py.File(remote_file)",
-            "io = pynwb.NWBHDF5IO(file=h5_file)",
-            "nwb = io.read()",
-        ])
-    elif is_url and is_lindi:
-        header_lines.extend([
-            "import lindi",
-            "",
-            "# Load",
-            f"url = \"{url_or_path}\"",
-            "f = lindi.LindiH5pyFile.from_lindi_file(url)",
-            "io = pynwb.NWBHDF5IO(file=f, mode='r')",
-            "nwb = io.read()",
-        ])
-    elif not is_url and is_lindi:
-        header_lines.extend([
-            "import lindi",
-            "",
-            "# Load",
-            f"path = \"{url_or_path}\"",
-            "f = lindi.LindiH5pyFile.from_lindi_file(path)",
-            "io = pynwb.NWBHDF5IO(file=f, mode='r')",
-            "nwb = io.read()",
-        ])
-    else:  # not is_url and not is_lindi:
-        header_lines.extend([
-            "",
-            "# Load",
-            f"path = \"{url_or_path}\"",
-            "nwb = pynwb.read_nwb(path=path)",
-        ])
-
-    header_lines.append("")
-
-    # Read the NWB file using remfile for remote URLs
-    if is_url and not is_lindi:
-        import remfile
-        remote_file = remfile.File(url_or_path)
-        h5_file = h5py.File(remote_file)
-        io = pynwb.NWBHDF5IO(file=h5_file)
-    elif is_lindi:
-        import lindi
-        f = lindi.LindiH5pyFile.from_lindi_file(url_or_path)
-        io = pynwb.NWBHDF5IO(file=f, mode='r')
+    The cache is best-effort: if it cannot be read or written, a warning is issued and the script
+    is generated (or returned) as if use_cache were False.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached_script = f.read()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        warnings.warn(f"Could not read the cached script {cache_path}: {e}")
     else:
-        io = pynwb.read_nwb(path=url_or_path)  # type: ignore
+        yield from cached_script.split("\n")
+        return
+
+    generated_lines = []
+    for line in lines:
+        generated_lines.append(line)
+        yield line
+
+    # Write to a temporary file first so that concurrent runs never see a partial script
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(generated_lines))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        warnings.warn(f"Could not cache the script in {cache_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+# Open remote NWB files, (url, cache_dir) -> (io, nwb), from least to most recently used
+_open_remote_nwb_files = OrderedDict()
+# Number of callers currently using each entry of _open_remote_nwb_files
+_open_remote_nwb_files_in_use = Counter()
 
+@contextlib.contextmanager
+def _open_nwb(url_or_path: str, cache_dir: Optional[str] = None):
+    """
+    Open an NWB file for reading and yield the NWBFile.
+
+    Remote files are left open afterwards, so that repeated calls for the same URL do not read the
+    file again. The OPEN_REMOTE_FILES_CACHE_SIZE most recently used remote files are kept; older
+    ones are closed, and the rest are closed at interpreter exit. Local files are closed on exit
+    from the context, so that they are not kept locked or read stale after being rewritten. If
+    cache_dir is given, byte ranges fetched from remote (non-lindi) files are also cached on disk
+    in that directory and reused across processes.
+    """
+    if not url_or_path.startswith(('http://', 'https://')):
+        io, nwb = _read_nwb(url_or_path, cache_dir=cache_dir)
+        try:
+            yield nwb
+        finally:
+            io.close()
+        return
+
+    key = (url_or_path, cache_dir)
+    entry = _open_remote_nwb_files.pop(key, None)
+    if entry is None:
+        entry = _read_nwb(url_or_path, cache_dir=cache_dir)
+    _open_remote_nwb_files[key] = entry
+    _open_remote_nwb_files_in_use[key] += 1
     try:
-        # Read the NWB file
+        # Close the least recently used files that are not in use
+        for old_key in list(_open_remote_nwb_files):
+            if len(_open_remote_nwb_files) <= OPEN_REMOTE_FILES_CACHE_SIZE:
+                break
+            if not _open_remote_nwb_files_in_use[old_key]:
+                old_io, _ = _open_remote_nwb_files.pop(old_key)
+                old_io.close()
+        yield entry[1]
+    finally:
+        _open_remote_nwb_files_in_use[key] -= 1
+        if not _open_remote_nwb_files_in_use[key]:
+            del _open_remote_nwb_files_in_use[key]
+
+@atexit.register
+def _close_remote_nwb_files():
+    while _open_remote_nwb_files:
+        _, (io, _) = _open_remote_nwb_files.popitem()
+        io.close()
+
+def _read_nwb(url_or_path: str, cache_dir: Optional[str] = None):
+    """Open an NWB file for reading and return a tuple (io, nwb)."""
+    import pynwb
+
+    h5_file = _open_hdf5(url_or_path, cache_dir=cache_dir)
+    if h5_file is not None:
+        io = pynwb.NWBHDF5IO(file=h5_file, mode='r')
         nwb = io.read()
+    else:
+        # e.g., Zarr
+        nwb = pynwb.read_nwb(path=url_or_path)  # type: ignore
+        io = nwb.read_io
+    return io, nwb
 
-        # Process the NWB file - collect results in a list
-        results_list = process_nwb_container(nwb, expression="nwb", variable_names_in_scope=[])
+def _open_hdf5(url_or_path: str, cache_dir: Optional[str] = None):
+    """
+    Open the HDF5 file (or lindi file) at a URL or path for reading.
 
-        if len(results_list) != len(set(results_list)):
-            warnings.warn("Warning: Duplicate entries found in the results.")
+    Returns None for local files that are not HDF5 files.
+    """
+    return _get_loader(url_or_path).open_hdf5(url_or_path, cache_dir)
 
-        # Combine header and results
-        all_lines = header_lines + results_list
+def _open_remote_hdf5(url: str, cache_dir: Optional[str] = None):
+    # Read the file using fsspec or remfile
+    remote_file = _open_remote_file(url, cache_dir=cache_dir)
+    return _open_h5py_file(remote_file)
 
-        return "\n".join(all_lines)
-    finally:
-        io.close()
+def _open_lindi(url_or_path: str, cache_dir: Optional[str] = None):
+    import lindi
+    return lindi.LindiH5pyFile.from_lindi_file(url_or_path)
 
+def _open_local_hdf5(path: str, cache_dir: Optional[str] = None):
+    if h5py.is_hdf5(path):
+        return _open_h5py_file(path)
+    return None
 
-def get_variable_name_for_string(name: str, variable_names_in_scope: List[str]) -> str:
+def _blosc2_fast_slicing():
     """
-    Generate a variable name for a string that is not already in use in the given scope.
+    Return a context manager that enables b2h5py's optimized slicing of Blosc2-compressed datasets.
+
+    While active, slices of Blosc2-compressed datasets are read by decompressing only the needed
+    blocks of each chunk instead of going through the HDF5 filter pipeline. This does nothing if
+    b2h5py is not installed. The optimization can be disabled by setting BLOSC2_FILTER=1 in the
+    environment.
     """
-    if not name:
-        return ""
+    try:
+        import b2h5py
+    except ImportError:
+        return contextlib.nullcontext()
+    return b2h5py.fast_slicing()
+
+def _open_h5py_file(file_or_path):
+    """
+    Open an HDF5 file read-only with enlarged chunk and metadata caches.
+
+    Walking an NWB file is dominated by metadata reads, and the walk revisits the same B-tree nodes
+    and object headers many times, so a larger metadata cache avoids re-reading them (which for
+    remote files means another HTTP request).
+    """
+    h5_file = h5py.File(
+        file_or_path,
+        "r",
+        rdcc_nbytes=HDF5_CHUNK_CACHE_NBYTES,
+        rdcc_nslots=HDF5_CHUNK_CACHE_NSLOTS,
+        rdcc_w0=HDF5_CHUNK_CACHE_W0,
+    )
+    mdc_config = h5_file.id.get_mdc_config()
+    mdc_config.max_size = HDF5_METADATA_CACHE_MAX_SIZE
+    mdc_config.min_size = HDF5_METADATA_CACHE_MIN_SIZE
+    mdc_config.set_initial_size = True
+    mdc_config.initial_size = HDF5_METADATA_CACHE_MIN_SIZE
+    h5_file.id.set_mdc_config(mdc_config)
+    return h5_file
+
+def _open_remote_file(url: str, cache_dir: Optional[str] = None):
+    """
+    Open a remote file as a read-only file-like object.
 
-    # Remove special characters and replace spaces with underscores
-    sanitized_name = ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
-    sanitized_name = sanitized_name.replace(' ', '_')
+    If fsspec (with aiohttp) is installed and no disk cache is requested, the file is opened with
+    fsspec's block cache so that the many small reads h5py makes for metadata are served from
+    blocks of REMOTE_BLOCK_SIZE bytes (or GET_NWBFILE_INFO_BLOCK_SIZE, if set) fetched in a single
+    request each. Otherwise remfile is used.
+    """
+    if not cache_dir:
+        try:
+            import fsspec
+            import aiohttp  # noqa: F401 (needed by fsspec for HTTP)
+        except ImportError:
+            pass
+        else:
+            return fsspec.open(url, mode="rb", cache_type="blockcache", block_size=_get_remote_block_size()).open()
+
+    import remfile
+    disk_cache = remfile.DiskCache(cache_dir) if cache_dir else None
+    return remfile.File(url, disk_cache=disk_cache)
+
+def _get_remote_block_size() -> int:
+    # Read when a file is opened rather than at import, so that a malformed value is reported as
+    # an error of the call instead of breaking the import of this module
+    value = os.environ.get("GET_NWBFILE_INFO_BLOCK_SIZE")
+    if value is None:
+        return REMOTE_BLOCK_SIZE
+    try:
+        block_size = int(value)
+    except ValueError:
+        block_size = 0
+    if block_size <= 0:
+        raise ValueError(f"GET_NWBFILE_INFO_BLOCK_SIZE must be a positive number of bytes, got {value!r}")
+    return block_size
+
+class _Loader(NamedTuple):
+    """How a kind of file is opened, and the header that shows how to open it in the generated script."""
+    header_template: str
+    # Called with (url_or_path, cache_dir). Returns an h5py-like file, or None if the file is not HDF5.
+    open_hdf5: Callable[[str, Optional[str]], Any]
+
+# Loaders keyed by (is_url, is_lindi), so that the header of the generated script and the way the
+# file is opened are chosen together. The header shows the plain way to load each kind of file,
+# which is not always what is used here: remote HDF5 files are read through fsspec when it is
+# installed (see _open_remote_file), and local HDF5 files are opened with larger HDF5 caches.
+_LOADERS = {
+    (True, False): _Loader(_HEADER_REMOTE, _open_remote_hdf5),
+    (True, True): _Loader(_HEADER_REMOTE_LINDI, _open_lindi),
+    (False, True): _Loader(_HEADER_LOCAL_LINDI, _open_lindi),
+    (False, False): _Loader(_HEADER_LOCAL, _open_local_hdf5),
+}
+
+def _get_loader(url_or_path: str) -> _Loader:
+    is_url = url_or_path.startswith(('http://', 'https://'))
+    is_lindi = url_or_path.endswith(('.lindi.json', '.lindi.tar'))
+    return _LOADERS[(is_url, is_lindi)]
+
+# Matches characters that cannot appear in a Python identifier
+_NON_IDENTIFIER_CHARACTER_RE = re.compile(r"\W")
+
+
+@functools.lru_cache(maxsize=4096)
+def _sanitize_variable_name(name: str) -> str:
+    # Cached because the same keys (e.g. the names of processing modules and their data
+    # interfaces) appear in many places in an NWB file
+
+    # Replace special characters (including spaces) with underscores
+    sanitized_name = _NON_IDENTIFIER_CHARACTER_RE.sub('_', name)
 
     # Ensure the name does not start with a digit
     if sanitized_name and sanitized_name[0].isdigit():
         sanitized_name = '_' + sanitized_name
+    return sanitized_name
+
+def get_variable_name_for_string(name: str, variable_names_in_scope: Collection[str]) -> str:
+    """
+    Generate a variable name for a string that is not already in use in the given scope.
+    """
+    if not name:
+        return ""
+
+    sanitized_name = _sanitize_variable_name(name)
 
     # Ensure the name is unique in the given scope
     if sanitized_name not in variable_names_in_scope: